@@ -11,6 +11,7 @@
 #      You should have received a copy of the GNU Affero General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import functools
 import numpy as np
 import h5py
 from typing import NoReturn
@@ -18,12 +19,39 @@ from DIC_Exchange import mesh_utils
 import logging
 import time as ptime
 
+try:
+    import hdf5plugin  # registers the bitshuffle filter in h5py, for writing and reading
+except ImportError:
+    hdf5plugin = None
+
+FORMAT_VERSION = "0.2"
+"""version of the file layout written by save_to_hdf5"""
+
+STRAIN_COMPONENTS = ("eps_xx", "eps_yy", "eps_xy")
+"""names of the strain datasets, in the order of the last axis of DIC_Result.strains"""
+
+COORD_COMPONENTS = ("x", "y", "z")
+"""names of the coordinate datasets, in the order of the last axis of DIC_Result.coords"""
+
 
 class DIC_Result:
     """
     Class providing the data models and input output methods for handling DIC results for material testing
     """
 
+    _item_getters = {"eps": lambda res: res.strains,
+                     "eps_xx": lambda res: res.strains[:, :, 0],
+                     "eps_yy": lambda res: res.strains[:, :, 1],
+                     "eps_xy": lambda res: res.strains[:, :, 2],
+                     "eps_1": lambda res: res.get_principal_strains(which=1),
+                     "eps_2": lambda res: res.get_principal_strains(which=2),
+                     "x": lambda res: res.coords[:, :, 0],
+                     "y": lambda res: res.coords[:, :, 1],
+                     "z": lambda res: res.coords[:, :, 2],
+                     "force": lambda res: res.force,
+                     "time": lambda res: res.time}
+    """dispatch table of the keys accepted by __getitem__"""
+
     def __init__(self, coords: np.ndarray, strains: np.ndarray, force: np.ndarray, time: np.ndarray, mesh: np.ndarray,
                  node_normal: np.ndarray = None):
         """
@@ -45,10 +73,12 @@ class DIC_Result:
         """Value of the force as an array shape=(n_timesteps,)"""
         self.time = time
         """Value of the time as an array shape=(n_timesteps,)"""
-        self._mesh = mesh
-        """private attribute containing the mesh"""
+        self._mesh = _as_mesh_array(mesh)
+        """private attribute containing the mesh, node indexes are stored as uint32"""
+        self._mesh_hash = _array_hash(self._mesh)
+        """hash of the mesh content, the mesh properties are only reset when it changes"""
 
-        self.meta_data = {"version": "0.1"}
+        self.meta_data = {"version": FORMAT_VERSION}
         """Some metadata which are accessible to the users and can will be written in the file"""
 
         self.node_normals = node_normal
@@ -58,8 +88,6 @@ class DIC_Result:
             logging.info(f"{ptime.strftime('%H:%M:%S')} Done computing normals")
         """normal to the surface at the node coordinates, usefull to handle local coordinate systems"""
 
-        self._init_mesh_property()
-
     def get_mesh(self):
         """
         getter for the mesh
@@ -70,17 +98,29 @@ class DIC_Result:
         """
         setter for the mesh
         """
-        self._mesh = mesh
-        self._init_mesh_property()
+        self._mesh = _as_mesh_array(mesh)
+        mesh_hash = _array_hash(self._mesh)
+        if mesh_hash != self._mesh_hash:
+            self._mesh_hash = mesh_hash
+            self._init_mesh_property()
 
     mesh = property(get_mesh, set_mesh, doc="""mesh array shape=(n_elements, 3)""")
 
     def _init_mesh_property(self):
         """
-        Compute the mesh properties
+        Reset the mesh properties, they are computed again on their next access
         """
-        self.mesh_holes = mesh_utils.mesh_holes(self._mesh)
-        self.has_mesh_holes = len(self.mesh_holes) > 1
+        self.__dict__.pop("mesh_holes", None)
+
+    @functools.cached_property
+    def mesh_holes(self) -> list:
+        """closed boundaries of the mesh, one continuous boundary plus one for every hole"""
+        return mesh_utils.mesh_holes(self._mesh)
+
+    @property
+    def has_mesh_holes(self) -> bool:
+        """True if the mesh has more than one continuous boundary"""
+        return len(self.mesh_holes) > 1
 
     def _compute_node_normal(self):
         """
@@ -89,15 +129,24 @@ class DIC_Result:
         """
         self.node_normals = mesh_utils.node_surface_normal(self._mesh, self.coords)
 
-    def save_to_hdf5(self, path_h5: str) -> None:
+    def save_to_hdf5(self, path_h5: str, compression: str = "gzip", compression_opts=None,
+                     timestep_chunks: bool = True, single_precision: bool = False) -> None:
         """
         Save the Dic Result in a hdf5 file
         :param str path_h5: path to write the file
+        :param str compression: compression filter applied to the vector datasets and the mesh ("gzip", "lzf",
+            "bitshuffle" or None for no compression), "gzip" is readable by every HDF5 build, "lzf" only ships with
+            h5py and "bitshuffle" requires hdf5plugin (falls back to "gzip") to be read
+        :param compression_opts: options of the compression filter, e.g. the level for "gzip"
+        :param bool timestep_chunks: store the vector datasets in chunks of one timestep, so that reading a single
+            timestep does not read the whole dataset
+        :param bool single_precision: store the vector datasets as float32
         """
         with h5py.File(path_h5, "w") as hdf5:
             # Saving metadata
             for a_meta_key in self.meta_data.keys():
                 hdf5.attrs[a_meta_key] = self.meta_data[a_meta_key]
+            hdf5.attrs["version"] = FORMAT_VERSION
 
             # Saving the scalars
             hdf5.create_group("scalar")
@@ -106,12 +155,20 @@ class DIC_Result:
 
             # Saving the vector information
             hdf5.create_group("vector")
-            hdf5["vector"].create_dataset("strains", data=self.strains)
-            hdf5["vector"].create_dataset("coordinates", data=self.coords)
-            hdf5["vector"].create_dataset("node_normals", data=self.node_normals)
-
-            # Saving the mesh
-            hdf5.create_dataset("mesh", data=self._mesh)
+            # one dataset per component, so that reading a component does not read the other ones
+            vector_datasets = [(name, self.strains[:, :, i]) for i, name in enumerate(STRAIN_COMPONENTS)] + \
+                              [(name, self.coords[:, :, i]) for i, name in enumerate(COORD_COMPONENTS)] + \
+                              [("node_normals", self.node_normals)]
+            for name, data in vector_datasets:
+                if single_precision:
+                    data = data.astype(np.float32)
+                chunks = (1,) + data.shape[1:] if timestep_chunks else True
+                hdf5["vector"].create_dataset(name, data=data,
+                                              **_dataset_options(data, chunks, compression, compression_opts))
+
+            # Saving the mesh, small indexes which compress well once shuffled
+            hdf5.create_dataset("mesh", data=self._mesh, dtype=np.uint32,
+                                **_dataset_options(self._mesh, True, compression, compression_opts))
 
     @classmethod
     def load_from_hdf5(cls, path: str) -> "DIC_Result":
@@ -129,21 +186,26 @@ class DIC_Result:
             for el in h5file.attrs:
                 buff_meta_data[el] = h5file.attrs[el]
 
-            # read scalar
+            # read scalar, every dataset is read at once in a single hyperslab selection
 
-            force = np.array(h5file["scalar"]["force"])
-            time = np.array(h5file["scalar"]["time"])
+            force = h5file["scalar"]["force"][...]
+            time = h5file["scalar"]["time"][...]
 
             # read vector
-            coords = np.array(h5file["vector"]["coordinates"])
-            strains = np.array(h5file["vector"]["strains"])
+            if "strains" in h5file["vector"]:
+                # version 0.1 layout, with all the components in one dataset
+                coords = h5file["vector"]["coordinates"][...]
+                strains = h5file["vector"]["strains"][...]
+            else:
+                coords = _read_components(h5file["vector"], COORD_COMPONENTS)
+                strains = _read_components(h5file["vector"], STRAIN_COMPONENTS)
             try:
-                node_normals = np.array(h5file["vector"]["node_normals"])
+                node_normals = h5file["vector"]["node_normals"][...]
             except KeyError:
                 node_normals = None
 
-            # read mesh
-            mesh = np.array(h5file["mesh"])
+            # read mesh, older files may store it as int64
+            mesh = h5file["mesh"][...]
 
             load_hdf5 = cls(coords, strains, force, time, mesh, node_normals)
             load_hdf5.meta_data = buff_meta_data
@@ -154,58 +216,57 @@ class DIC_Result:
 
         """
         Get specific value of strain or coords
-        :param item:
-        :return:
+        :param str item: one of the keys of _item_getters, e.g. "eps_xx", "x" or "force"
+        :return: the corresponding array
         """
 
-        if type(item) == str:
-            if "eps" in item:
-                # strain
-                if item == "eps":
-                    return self.strains
-                elif item == "eps_xx":
-                    return self.strains[:, :, 0]
-                elif item == "eps_yy":
-                    return self.strains[:, :, 1]
-                elif item == "eps_xy":
-                    return self.strains[:, :, 2]
-                elif item == "eps_1":
-                    return self.get_principal_strains(which=1)
-                elif item == "eps_2":
-                    return self.get_principal_strains(which=2)
-            elif item == "x":
-                return self.coords[:, :, 0]
-            elif item == "y":
-                return self.coords[:, :, 1]
-            elif item == "z":
-                return self.coords[:, :, 2]
-            elif item == "force":
-                return self.force
-            elif item == "time":
-                return self.time
-        raise KeyError(str(item) + " is not a valuable key")
-
-    def get_principal_strains(self, which: int = 1) -> np.ndarray:
+        try:
+            getter = self._item_getters[item]
+        except (KeyError, TypeError):
+            raise KeyError(str(item) + " is not a valuable key") from None
+        return getter(self)
+
+    def get_principal_strains(self, which: int = 1, return_both: bool = False):
         """
         Compute the principal strain
         :param int which: 1 or 2 to get first or second principal strain
-        :return: computed principal strain
-        """
-        if which == 1:
-            return (self.strains[:, :, 0] + self.strains[:, :, 1]) / 2 + \
-                np.sqrt(((self.strains[:, :, 0] + self.strains[:, :, 1]) ** 2) / 2 - self.strains[:, :, 2] ** 2)
-        elif which == 2:
-            return (self.strains[:, :, 0] + self.strains[:, :, 1]) / 2 - \
-                np.sqrt(((self.strains[:, :, 0] + self.strains[:, :, 1]) ** 2) / 2 - self.strains[:, :, 2] ** 2)
-        else:
+        :param bool return_both: compute both principal strains in one pass, which is then ignored
+        :return: computed principal strain, or the tuple (first, second) if return_both
+        """
+        if not return_both and which not in (1, 2):
             raise KeyError("There are only two principal strain, 1 and 2")
 
+        eps_xx = self.strains[:, :, 0]
+        eps_yy = self.strains[:, :, 1]
+        eps_xy = self.strains[:, :, 2]
+
+        # center and radius of the Mohr circle, computed in place to limit the temporaries
+        radius = np.subtract(eps_xx, eps_yy)
+        radius *= 0.5
+        np.square(radius, out=radius)
+        radius += np.square(eps_xy)
+        np.sqrt(radius, out=radius)
+
+        mean_strain = np.add(eps_xx, eps_yy)
+        mean_strain *= 0.5
+
+        if return_both:
+            first = mean_strain + radius
+            mean_strain -= radius
+            return first, mean_strain
+        elif which == 1:
+            mean_strain += radius
+        else:
+            mean_strain -= radius
+        return mean_strain
+
     def translate(self, vector: "np.ndarray(shape=(3,))") -> NoReturn:
         """
         Translate the coordinate system
         :param np.ndarray vector: translation vector
         """
-        self.coords + vector
+        # in place, broadcast over all the timesteps and points
+        self.coords += np.asarray(vector, dtype=self.coords.dtype)
 
     def rotate(self, matrix: 'np.ndarray(shape=(3,3))'):
         """
@@ -218,30 +279,85 @@ class DIC_Result:
 
         # However rotating the strain is more complicated because the strain
         # must be computed in the local coordinate system
-        old_e_x = np.cross(self.node_normals, np.array([0, 1, 0]), axis=-1)
-        norm_old_e_x = np.linalg.norm(old_e_x, axis=-1)
-        old_e_x[:, :, 0] /= norm_old_e_x
-        old_e_x[:, :, 1] /= norm_old_e_x
-        old_e_x[:, :, 2] /= norm_old_e_x
+        # local x axis, cross product of the normal with the y axis: n x (0, 1, 0) = (-n_z, 0, n_x)
+        old_e_x = np.stack([-self.node_normals[..., 2],
+                            np.zeros_like(self.node_normals[..., 0]),
+                            self.node_normals[..., 0]], axis=-1)
+        old_e_x /= np.linalg.norm(old_e_x, axis=-1, keepdims=True)
         new_e_x = np.einsum("ik, ...k -> ...i", matrix, old_e_x)
 
         cos_th = np.einsum("...i, ...i -> ...", old_e_x, new_e_x)
 
         cp_e_x = np.cross(old_e_x, new_e_x, axis=-1)
-        sgn_th = np.sign(np.einsum("...i, ...j -> ...", cp_e_x, self.node_normals))
+        sgn_th = np.sign(np.einsum("...i, ...i -> ...", cp_e_x, self.node_normals))
         sin_th = np.linalg.norm(cp_e_x, axis=-1) * sgn_th
 
-        new_strains = np.zeros_like(self.strains)
-        new_strains[:, :, 0] = self.strains[:, :, 0] * cos_th ** 2 \
-                               + self.strains[:, :, 1] * sin_th ** 2 \
-                               + self.strains[:, :, 2] * sin_th * cos_th
+        # strain transformation matrix of every point, applied in a single product
+        cos2_th = cos_th ** 2
+        sin2_th = sin_th ** 2
+        sincos_th = sin_th * cos_th
+        transformation = np.stack([np.stack([cos2_th, sin2_th, sincos_th], axis=-1),
+                                   np.stack([sin2_th, cos2_th, -sincos_th], axis=-1),
+                                   np.stack([2 * sincos_th, -2 * sincos_th, cos2_th - sin2_th], axis=-1)], axis=-2)
 
-        new_strains[:, :, 1] = self.strains[:, :, 0] * sin_th ** 2 \
-                               + self.strains[:, :, 1] * cos_th ** 2 \
-                               - self.strains[:, :, 2] * sin_th * cos_th
+        self.strains = np.einsum("...ij, ...j -> ...i", transformation, self.strains)
+        self.node_normals = np.einsum("ik, ...k -> ...i", matrix, self.node_normals)
 
-        new_strains[:, :, 2] = 2 * (self.strains[:, :, 0] - self.strains[:, :, 1]) * sin_th * cos_th \
-                               + self.strains[:, :, 2] * (cos_th ** 2 - sin_th ** 2)
 
-        self.strains = new_strains
-        self.node_normals = np.einsum("ik, ...k -> ...i", matrix, self.node_normals)
+def _dataset_options(data: np.ndarray, chunks, compression: str, compression_opts) -> dict:
+    """
+    Storage options of a dataset for h5py create_dataset
+    :param np.ndarray data: data of the dataset
+    :param chunks: chunk shape, or True to let h5py guess it
+    :param str compression: compression filter, "bitshuffle" or an h5py one, None for contiguous uncompressed storage
+    :param compression_opts: options of the compression filter
+    :return dict: keyword arguments for create_dataset
+    """
+    if compression is None or data.size == 0:
+        return {}
+    if compression == "bitshuffle":
+        if hdf5plugin is not None:
+            # bitshuffle already reorders the bits by significance before the LZ4 compression
+            return {"chunks": chunks, **hdf5plugin.Bitshuffle(nelems=0, cname="lz4")}
+        logging.warning("hdf5plugin is not installed, falling back to gzip compression")
+        compression = "gzip"
+    # the shuffle filter groups the bytes of same significance, which compress much better
+    return {"chunks": chunks, "compression": compression, "compression_opts": compression_opts, "shuffle": True}
+
+
+def _as_mesh_array(mesh) -> np.ndarray:
+    """
+    Convert a mesh to its uint32 storage, the node indexes are checked first so that none is wrapped by the cast
+    :param mesh: mesh represented by an array of shape (q, 3) with node indexes
+    :return np.ndarray: mesh as an uint32 array
+    """
+    mesh = np.asarray(mesh)
+    # written as negated bounds so that nan indexes are rejected as well
+    if mesh.size and not (np.min(mesh) >= 0 and np.max(mesh) <= np.iinfo(np.uint32).max):
+        raise ValueError("Mesh node indexes must be in the range of uint32 [0, 2**32 - 1]")
+    return mesh.astype(np.uint32, copy=False)
+
+
+def _array_hash(array: np.ndarray) -> int:
+    """
+    Hash of the content of an array
+    :param np.ndarray array: array to hash
+    :return int: hash of the shape, type and data of the array
+    """
+    array = np.asarray(array)
+    return hash((array.shape, array.dtype.str, array.tobytes()))
+
+
+def _read_components(group: h5py.Group, names: tuple) -> np.ndarray:
+    """
+    Read datasets of the same shape and stack them along a new last axis
+    :param h5py.Group group: group containing the datasets
+    :param tuple names: names of the datasets, in the stacking order
+    :return np.ndarray: array of shape dataset_shape + (len(names),)
+    """
+    first = group[names[0]]
+    array = np.empty(first.shape + (len(names),), dtype=first.dtype)
+    if array.size != 0:
+        for i, name in enumerate(names):
+            group[name].read_direct(array, dest_sel=np.s_[..., i])
+    return array
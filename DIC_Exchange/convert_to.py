@@ -24,7 +24,8 @@ def load_from(path: str, file_type: str = "ARAMIS_XML",
               force_max: float = None, offset_force_max: int = 0,
               force_min: float = None, offset_force_min: int = 0,
               time_min: float = None, offset_time_min: int = 0,
-              time_max: float = None, offset_time_max: int = 0):
+              time_max: float = None, offset_time_max: int = 0,
+              max_workers: int = 1):
     """
     Load the results of a DIC-Engine
     :param path: path of the file
@@ -42,19 +43,23 @@ def load_from(path: str, file_type: str = "ARAMIS_XML",
     :param offset_time_min: offset for the value determined by setting time_min
     :param time_max: discard all timesteps after the time_max
     :param offset_time_max: offset for the value determined by setting time_max
+    :param max_workers: number of processes used to decode the file, sequential by default, all the cores if None.
+        The processes are spawned, a value other than 1 requires the calling script to guard its entry point with
+        if __name__ == "__main__":
     :return:
     """
 
     if file_type == "ARAMIS_XML":
-        coords, strains, force, time, mesh = parsers.ARAMIS_XML_Parser.parse(path_xml=path)
+        coords, strains, force, time, mesh, element_set = parsers.ARAMIS_XML_Parser.parse(path_xml=path,
+                                                                                         max_workers=max_workers)
     else:
         raise NotImplementedError("No Parser for file_type=" + file_type)
 
     the_first_time_step = 0
-    the_last_time_step = len(coords.keys())
+    the_last_time_step = len(time)
 
-    force_values = np.array(list(force.values()))
-    time_values = np.array(list(time.values()))
+    force_values = force
+    time_values = time
 
     if last_time_step is not None:
         the_last_time_step = min(last_time_step, the_last_time_step)
@@ -64,37 +69,39 @@ def load_from(path: str, file_type: str = "ARAMIS_XML",
 
     if force_rupture_ratio is not None:
         threshold = force_rupture_ratio * force_values.max()
-        rupture = np.max(np.where(force_values >= threshold))
+        rupture = _last_true(force_values >= threshold)
         rupture += offset_force_rupture_ratio
         the_last_time_step = min(rupture, the_last_time_step)
 
     if force_max is not None:
         threshold = force_max
-        rupture = np.max(np.where(force_values <= threshold))
+        rupture = _last_true(force_values <= threshold)
         rupture += offset_force_max
         the_last_time_step = min(rupture, the_last_time_step)
 
     if force_min is not None:
         threshold = force_min
-        rupture = np.min(np.where(force_values >= threshold))
+        rupture = _first_true(force_values >= threshold)
         rupture += offset_force_min
         the_first_time_step = max(rupture, the_first_time_step)
 
     if time_min is not None:
         threshold = time_min
-        start_time = np.min(np.where(time_values >= threshold))
+        start_time = int(np.searchsorted(time_values, threshold))  # time is increasing
+        if start_time == len(time_values):
+            raise ValueError("The threshold is never reached")
         start_time += offset_time_min
         the_first_time_step = max(start_time, the_first_time_step)
 
     if time_max is not None:
         threshold = time_max
-        stop_time = np.min(np.where(time_values >= threshold))
+        stop_time = int(np.searchsorted(time_values, threshold))  # time is increasing
         stop_time += offset_time_max
         the_last_time_step = min(stop_time, the_last_time_step)
 
     logging.debug(f"selecting timestep {the_first_time_step}:{the_last_time_step}:{thinning}")
 
-    coords_a, strains_a, force_a, time_a, mesh_a = _numpyfi(coords, strains, force, time, mesh,
+    coords_a, strains_a, force_a, time_a, mesh_a = _numpyfi(coords, strains, force, time, mesh, element_set,
                                                             fstep=the_first_time_step,
                                                             lstep=the_last_time_step, step=thinning)
 
@@ -102,86 +109,65 @@ def load_from(path: str, file_type: str = "ARAMIS_XML",
                                                 time=time_a, mesh=mesh_a)
 
 
-def _numpyfi(coords_o, strains_o, force_o, time_o, mesh_o, fstep=0, lstep=-1, step=1):
-    # get_the set of element
-
-    logging.info(f"{ptime.strftime('%H:%M:%S')} Prepare numpy")
-
-    list_stage = list(time_o.keys())
-    list_stage = list_stage[fstep:lstep:step]
-    element_set = set(coords_o[list_stage[0]].keys())
-    for a_stage in list_stage:
-        a_coord = coords_o[a_stage]
-        element_set = element_set.intersection(set(a_coord.keys()))
-
-    element_set = list(element_set)  # order preservation
-
-    logging.debug(f"final elements set with {len(element_set)} elements")
-
-    logging.info(f"{ptime.strftime('%H:%M:%S')} Start converting Mesh")
-
-    # clean the mesh
-    mesh_buff = []
-    for el in mesh_o:
-        if all([el[i] in element_set for i in range(3)]):
-            mesh_buff.append([element_set.index(el[i]) for i in range(3)])
-    mesh = np.array(mesh_buff)
-
-    element_set = list(element_set)
-    element_set.sort()
-
-    logging.info(f"{ptime.strftime('%H:%M:%S')} Done converting Mesh")
-
-    logging.info(f"{ptime.strftime('%H:%M:%S')} Start converting coordinates")
-
-
-    # stacking the coordinates
-    coords_np = []
-    for a_stage in list_stage:
-        buff_coords = []
-        for a_el in element_set:
-            buff_coords.append(coords_o[a_stage][a_el])
-        coords_np.append(buff_coords)
-
-    del coords_o
-
-    coords = np.array(coords_np)
-
-    del coords_np
+def _first_true(condition: np.ndarray) -> int:
+    """
+    Index of the first True value, argmax stops at the first maximum
+    :param np.ndarray condition: boolean array
+    :return int: index of the first True value
+    """
+    index = int(np.argmax(condition))
+    if not condition[index]:
+        raise ValueError("The threshold is never reached")
+    return index
 
-    logging.info(f"{ptime.strftime('%H:%M:%S')} Done converting coordinates")
 
-    logging.info(f"{ptime.strftime('%H:%M:%S')} Start converting strains")
+def _last_true(condition: np.ndarray) -> int:
+    """
+    Index of the last True value
+    :param np.ndarray condition: boolean array
+    :return int: index of the last True value
+    """
+    return len(condition) - 1 - _first_true(condition[::-1])
 
-    # stacking the strains
-    strains_np = []
-    for a_stage in list_stage:
 
-        buff = []
-        for an_eps in ["eps_xx", "eps_yy", "eps_xy"]:
-            indexes_argsort = np.argsort(strains_o[an_eps][a_stage][0])
-            are_in_loc = np.isin(strains_o[an_eps][a_stage][0][indexes_argsort], element_set)
-            buff.append(strains_o[an_eps][a_stage][1][indexes_argsort][are_in_loc])
+def _numpyfi(coords_o, strains_o, force_o, time_o, mesh_o, element_set, fstep=0, lstep=-1, step=1):
+    """
+    Select the timesteps and the elements available in all of them
+    :param coords_o: coordinates array (n_stage, n_el, 3), nan where an element is missing
+    :param strains_o: strains array (n_stage, n_el, 3), nan where an element is missing
+    :param force_o: force array (n_stage,)
+    :param time_o: time array (n_stage,)
+    :param mesh_o: mesh array (q, 3) with the element indexes
+    :param element_set: sorted element indexes (n_el,)
+    :param fstep: first selected stage
+    :param lstep: stop of the stage selection
+    :param step: step of the stage selection
+    :return: coords, strains, force, time and mesh, with the mesh referring to the positions in the arrays
+    """
 
-        strains_np.append(buff)
+    logging.info(f"{ptime.strftime('%H:%M:%S')} Prepare numpy")
 
-    del strains_o
-    strains = np.array(strains_np).swapaxes(-1, 1)
-    del strains_np
+    stage_selection = slice(fstep, lstep, step)
+    coords = coords_o[stage_selection]
+    strains = strains_o[stage_selection]
+    force = force_o[stage_selection]
+    time = time_o[stage_selection]
 
-    strains
+    # get the set of elements available in all the selected stages
+    is_available = np.logical_not(np.isnan(coords).any(axis=(0, 2)) | np.isnan(strains).any(axis=(0, 2)))
+    element_set = element_set[is_available]
+    coords = coords[:, is_available]
+    strains = strains[:, is_available]
 
-    logging.info(f"{ptime.strftime('%H:%M:%S')} Done converting strains")
+    logging.debug(f"final elements set with {len(element_set)} elements")
 
-    # turn force and time in arrays
-    time = []
-    force = []
-    for a_stage in list_stage:
-        time.append(time_o[a_stage])
-        force.append(force_o[a_stage])
+    logging.info(f"{ptime.strftime('%H:%M:%S')} Start converting Mesh")
 
-    time = np.array(time)
-    force = np.array(force)
+    # clean the mesh, keeping only the elements whose nodes are all available,
+    # and turn the node ids into indexes in the element set
+    mesh_o = np.asarray(mesh_o)
+    is_complete = np.all(np.isin(mesh_o, element_set), axis=1)
+    mesh = np.searchsorted(element_set, mesh_o[is_complete])
 
     logging.info(f"{ptime.strftime('%H:%M:%S')} Done Transforming file")
 
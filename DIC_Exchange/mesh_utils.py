@@ -11,65 +11,154 @@
 #      You should have received a copy of the GNU Affero General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import time
+from collections import defaultdict
 
 import numpy as np
 
-def node_surface_normal(mesh, coords):
-    nodes = np.arange(coords.shape[1])
+try:
+    import numba
+except ImportError:
+    numba = None
 
-    node_connection = dict()
-    for a_node in nodes:
-        is_in_el = np.sum(np.isin(mesh, a_node), axis=1, dtype=bool)
-        node_connection[a_node] = np.unique(mesh[is_in_el])
 
-    n_ts, n_node, _ = coords.shape
+def node_neighbours(mesh: "np.ndarray(shape=q, 3)", n_node: int) -> tuple:
+    """
+    Find for every node the nodes sharing at least one element with it, the node itself included
+    :param "np.ndarray(shape=q, 3)" mesh: array representing the mesh indexes (with q elements)
+    :param int n_node: number of nodes
+    :return: neighbours of all the nodes in a flat array and the offsets of every node in it (CSR layout),
+        the neighbours of node i are neighbours[offsets[i]:offsets[i + 1]]
+    """
+    mesh = np.asarray(mesh, dtype=np.int64).reshape(-1, 3)
 
-    matrix = []
+    # every node of an element is connected to the three nodes of this element
+    flat_nodes = mesh.ravel()
+    el_idx = np.repeat(np.arange(mesh.shape[0]), 3)
+    node_keys = np.repeat(flat_nodes, 3)
+    neighbour_keys = mesh[el_idx].ravel()
 
-    for i_node in range(n_node):
-        points = [coords[:, i_node, :], ]
-        for a_node in node_connection[i_node]:
-            points.append(coords[:, a_node, :])
-        points = np.array(points)
-        center = np.mean(points, axis=0)
-        points = points - center
-        points = points.swapaxes(0,1)
+    # sorting the unique connections by node, then by neighbour
+    connections = np.unique(node_keys * n_node + neighbour_keys)
+    nodes, neighbours = np.divmod(connections, n_node)
+
+    counts = np.bincount(nodes, minlength=n_node)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    return neighbours, offsets
+
+
+def node_surface_normal(mesh, coords):
+    n_ts, n_node, _ = coords.shape
 
-        matrix_series = np.matmul(points.swapaxes(-1, 1), points)
-        matrix.append(matrix_series)
+    neighbours, offsets = node_neighbours(mesh, n_node)
 
-    matrix = np.array(matrix)
+    if numba is not None:
+        matrix = _neighbourhood_covariance_numba(np.ascontiguousarray(coords, dtype=np.float64), neighbours, offsets)
+    else:
+        matrix = _neighbourhood_covariance(coords, neighbours, offsets)
 
     u, d, vh = np.linalg.svd(matrix, hermitian=True)
-    normals = u[:, :, :, -1].swapaxes(0,1)
+    normals = u[:, :, :, -1]
 
-    norm = np.linalg.norm(normals, axis=-1)
-    normals[:, :, 0] /= norm
-    normals[:, :, 1] /= norm
-    normals[:, :, 2] /= norm
+    normals /= np.linalg.norm(normals, axis=-1, keepdims=True)
 
     return normals
 
 
-def mesh_boundaries(mesh: "np.ndarray(shape=q, 3)") -> list:
+def _neighbourhood_covariance(coords, neighbours, offsets):
+    """
+    Covariance matrices of the node neighbourhoods, the node itself being counted twice
+    :param coords: coordinate array of shape (n_ts, n_node, 3)
+    :param neighbours: neighbours of the nodes in CSR layout, see node_neighbours
+    :param offsets: offsets of the nodes in neighbours, see node_neighbours
+    :return: covariance matrices of shape (n_ts, n_node, 3, 3)
+    """
+    n_ts, n_node, _ = coords.shape
+    counts = np.diff(offsets)
+
+    # neighbourhoods padded to the largest one, led by the node itself,
+    # the padding points get a null weight so that they do not contribute to the covariance
+    n_points = counts.max(initial=0) + 1
+    neighbour_idx = np.repeat(np.arange(n_node)[:, None], n_points, axis=1)
+    weight = np.zeros((n_node, n_points, 1))
+    weight[:, 0] = 1
+
+    node_of = np.repeat(np.arange(n_node), counts)
+    rank = np.arange(len(neighbours)) - offsets[node_of] + 1
+    neighbour_idx[node_of, rank] = neighbours
+    weight[node_of, rank] = 1
+    n_weight = weight.sum(axis=1, keepdims=True)
+
+    # covariance matrices of every neighbourhood, timestep per timestep to bound the memory usage
+    matrix = np.empty((n_ts, n_node, 3, 3))
+    for i_ts in range(n_ts):
+        points = coords[i_ts][neighbour_idx]
+        center = np.sum(points * weight, axis=1, keepdims=True) / n_weight
+        points = (points - center) * weight
+        matrix[i_ts] = np.einsum("nkd,nke->nde", points, points)
+
+    return matrix
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _neighbourhood_covariance_numba(coords, neighbours, offsets):
+        """
+        Compiled equivalent of _neighbourhood_covariance, working directly on the CSR neighbours, in parallel over
+        the nodes
+        """
+        n_ts, n_node, _ = coords.shape
+        matrix = np.zeros((n_ts, n_node, 3, 3))
+        for i_node in numba.prange(n_node):
+            start = offsets[i_node]
+            stop = offsets[i_node + 1]
+            n_points = stop - start + 1
+            for i_ts in range(n_ts):
+                # the center is accumulated in scalars, no array is allocated per node and timestep
+                c_x = coords[i_ts, i_node, 0]
+                c_y = coords[i_ts, i_node, 1]
+                c_z = coords[i_ts, i_node, 2]
+                for k in range(start, stop):
+                    c_x += coords[i_ts, neighbours[k], 0]
+                    c_y += coords[i_ts, neighbours[k], 1]
+                    c_z += coords[i_ts, neighbours[k], 2]
+                c_x /= n_points
+                c_y /= n_points
+                c_z /= n_points
+
+                # the node itself comes first, at k = start - 1
+                for k in range(start - 1, stop):
+                    a_node = np.int64(i_node) if k < start else np.int64(neighbours[k])
+                    d_x = coords[i_ts, a_node, 0] - c_x
+                    d_y = coords[i_ts, a_node, 1] - c_y
+                    d_z = coords[i_ts, a_node, 2] - c_z
+                    matrix[i_ts, i_node, 0, 0] += d_x * d_x
+                    matrix[i_ts, i_node, 0, 1] += d_x * d_y
+                    matrix[i_ts, i_node, 0, 2] += d_x * d_z
+                    matrix[i_ts, i_node, 1, 1] += d_y * d_y
+                    matrix[i_ts, i_node, 1, 2] += d_y * d_z
+                    matrix[i_ts, i_node, 2, 2] += d_z * d_z
+
+                # the covariance is symmetric
+                matrix[i_ts, i_node, 1, 0] = matrix[i_ts, i_node, 0, 1]
+                matrix[i_ts, i_node, 2, 0] = matrix[i_ts, i_node, 0, 2]
+                matrix[i_ts, i_node, 2, 1] = matrix[i_ts, i_node, 1, 2]
+        return matrix
+
+
+def mesh_boundaries(mesh: "np.ndarray(shape=q, 3)") -> "np.ndarray(shape=b, 2)":
     """
     Find the boundaries of a given mesh
     :param "np.ndarray(shape=q, 3)" mesh: array representing the mesh indexes (with q elements)
-    :return: unique half edges of the mesh (boundaries)
+    :return: unique half edges of the mesh (boundaries) as an array of node indexes pairs
     """
-    unique_half_edges = []
-    for el in mesh:
-
-        half_edges = [frozenset({el[0], el[1]}),
-                      frozenset({el[1], el[2]}),
-                      frozenset({el[0], el[2]})]
+    mesh = np.asarray(mesh).reshape(-1, 3)
+    edges = np.concatenate([mesh[:, [0, 1]], mesh[:, [1, 2]], mesh[:, [0, 2]]])
+    edges.sort(axis=1)
 
-        for an_half_edge in half_edges:
-            if an_half_edge in unique_half_edges:
-                unique_half_edges.remove(an_half_edge)
-            else:
-                unique_half_edges.append(an_half_edge)
-    return unique_half_edges
+    # an edge shared by two elements is inside the mesh, the boundary edges belong to only one element
+    unique_edges, counts = np.unique(edges, axis=0, return_counts=True)
+    return unique_edges[counts == 1]
 
 
 def mesh_holes(mesh: "np.ndarray(shape=q, 3)") -> list[list]:
@@ -78,36 +167,41 @@ def mesh_holes(mesh: "np.ndarray(shape=q, 3)") -> list[list]:
     :param "np.ndarray(shape=q, 3)" mesh: array representing the mesh indexes (with q elements)
     :return: list of continuous boundary segment
     """
-    unique_half_edges = mesh_boundaries(mesh)
+    unique_half_edges = mesh_boundaries(mesh).tolist()
+
+    # edges connected to every boundary node
+    node_edges = defaultdict(list)
+    for i_edge, (a_summit, b_summit) in enumerate(unique_half_edges):
+        node_edges[a_summit].append(i_edge)
+        node_edges[b_summit].append(i_edge)
+
+    visited = [False] * len(unique_half_edges)
     holes = []
-    unique_half_edges_set = set(unique_half_edges)
-    while len(unique_half_edges_set) != 0:
-        buff_hole = []
-        start_link = list(unique_half_edges_set.pop())
-        buff_hole.append(start_link)
-        next_summit = start_link[1]
-        end_summit = start_link[0]
-        link_running = True
-
-        while link_running:
-            unique_half_edges_set_to_remove = []
-            for an_half_edges in unique_half_edges_set:
-                if next_summit in an_half_edges:
-                    an_half_edges_l = list(an_half_edges)
-                    unique_half_edges_set_to_remove.append(an_half_edges)
-
-                    if an_half_edges_l[0] == next_summit:
-                        next_summit = an_half_edges_l[1]
-                        buff_hole.append(an_half_edges_l)
-                    else:
-                        next_summit = an_half_edges_l[0]
-                        buff_hole.append(an_half_edges_l[::-1])
-
-                    if end_summit in an_half_edges:
-                        link_running = False
-                        break
-            for an_half_edges_to_remove in unique_half_edges_set_to_remove:
-                unique_half_edges_set.remove(an_half_edges_to_remove)
+    for i_start in range(len(unique_half_edges)):
+        if visited[i_start]:
+            continue
+        visited[i_start] = True
+        start_link = unique_half_edges[i_start]
+        buff_hole = [start_link]
+        end_summit, next_summit = start_link
+
+        # walk along the boundary until coming back to the first summit
+        while next_summit != end_summit:
+            for i_edge in node_edges[next_summit]:
+                if not visited[i_edge]:
+                    break
+            else:
+                # open boundary, can only happen on non-manifold meshes
+                break
+            visited[i_edge] = True
+            an_half_edges_l = unique_half_edges[i_edge]
+
+            if an_half_edges_l[0] == next_summit:
+                next_summit = an_half_edges_l[1]
+                buff_hole.append(an_half_edges_l)
+            else:
+                next_summit = an_half_edges_l[0]
+                buff_hole.append(an_half_edges_l[::-1])
 
         holes.append(buff_hole)
     return holes
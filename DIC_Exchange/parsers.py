@@ -11,16 +11,37 @@
 #      You should have received a copy of the GNU Affero General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
 import struct
-import base64
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import warnings
-import xml.etree.ElementTree as ET
 import re
 from abc import ABC
 import time as ptime
 import logging
 
+try:
+    from lxml import etree as ET  # libxml2 based, much faster on large exports
+
+    _ITERPARSE_OPTIONS = {"huge_tree": True, "collect_ids": False, "remove_comments": True, "remove_pis": True}
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+    _ITERPARSE_OPTIONS = {}
+
+try:
+    import pybase64 as base64  # SIMD accelerated, same interface as the standard library module
+except ImportError:
+    import base64
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 class ABC_parser(ABC):
     @classmethod
@@ -38,12 +59,31 @@ class DICe_Parser(ABC_parser):
 
 #### Aramis Parser
 
-MAX_UINT = 2 ** 32 - 1
+MAX_UINT = np.float64(2 ** 32 - 1)
 LEN_INT = struct.calcsize("<I")
 LEN_DOUBLE = struct.calcsize("<d")
 LEN_CHAR = struct.calcsize("<c")
 LEN_FLOAT = struct.calcsize("<f")
 
+# binary headers of the surface components
+_U32 = struct.Struct("<I")
+_U8 = struct.Struct("<B")
+_HDR_TRI = struct.Struct("<II")
+_HDR_VERT = struct.Struct("<I6dI")
+
+# conversion factors of the units supported in the header, to mm, s, rad and N
+_UNIT_TABLES = {
+    "length_unit": {"mm": 1},
+    "time_unit": {"s": 1},
+    "angle_unit": {"deg": 1, "rad": 2 * np.pi / 360},
+    "force_unit": {"N": 1, "kN": 1e3},
+}
+
+# names of the strain surface components
+_RE_EPS_XY = re.compile(r"epsXY")
+_RE_EPS_XX = re.compile(r"epsX(?!Y)")
+_RE_EPS_YY = re.compile(r"epsY(?!X)")
+
 
 class ARAMIS_XML_Parser:
     """
@@ -52,126 +92,161 @@ class ARAMIS_XML_Parser:
     version = 0.1
 
     @classmethod
-    def parse(csl, path_xml):
+    def parse(csl, path_xml, max_workers=1):
+        """
+        Parse an Aramis XML export, with n stages and m elements
+        :param path_xml: path of the file
+        :param max_workers: number of processes decoding the stages, sequential by default, all the cores if None,
+            a value other than 1 requires an entry point guard in the calling script
+        :return: coordinates (n, m, 3) and strains (n, m, [eps_xx, eps_yy, eps_xy]) arrays, nan where an element is
+            missing in a stage, force (n,), time (n,), mesh (q, 3) with the element indexes,
+            and the sorted element indexes (m,)
+        """
 
         logging.info(f"{ptime.strftime('%H:%M:%S')} start reading XML data")
-        header_read, nominal_read, measured_read = read_file(path_xml)
+        header_read, nominal_read, measured_read = read_file(path_xml, max_workers=max_workers)
         logging.info(f"{ptime.strftime('%H:%M:%S')} start writing hdf5")
 
-        rel_time = []
-        stage_id = []
-        stage_name = []
-
         length_unit_factor, time_unit_factor, angle_unit_factor, force_unit_factor = header_read[1]
 
         """For not unis factor ar not in use"""
 
-        for stage in header_read[0]:
-            rel_time.append(float(stage["rel_time"]))
-            stage_name.append(str(stage["name"]))
-            stage_id.append(stage["id"])
+        stages_list = header_read[0]
+        rel_time = [float(stage["rel_time"]) for stage in stages_list]
+        stage_name = [str(stage["name"]) for stage in stages_list]
+        stage_id = [stage["id"] for stage in stages_list]
 
         triangle, coords = measured_read
 
         comparison_surface_list, dimension_list = nominal_read
-        force_values = [float(dimension_list[0][i][1]) for i in range(len(dimension_list[0]))]
-
-        list_epsilon = list(comparison_surface_list.keys())
-
-        eps_xx_key = None
-        eps_yy_key = None
-        eps_xy_key = None
+        force_values = [float(a_dimension[1]) for a_dimension in dimension_list[0]]
 
-        re_epx_xy = "^.*epsXY.*$"
-        re_eps_xx = "^.*epsX.*$"
-        re_eps_yy = "^.*epsY.*$"
+        # single pass over the surface components, the first match of every strain component is kept
+        strain_surfaces = {}
+        for a_key, a_surface in comparison_surface_list.items():
+            if _RE_EPS_XY.search(a_key):
+                strain_surfaces.setdefault("eps_xy", a_surface)
+            elif _RE_EPS_XX.search(a_key):
+                strain_surfaces.setdefault("eps_xx", a_surface)
+            elif _RE_EPS_YY.search(a_key):
+                strain_surfaces.setdefault("eps_yy", a_surface)
 
-        for i in range(3):
-            if re.match(re_epx_xy, list_epsilon[i]):
-                eps_xy_key = i
-                break
+        for a_component in ("eps_xx", "eps_yy", "eps_xy"):
+            if a_component not in strain_surfaces:
+                raise ValueError(f"No {a_component} surface component found in the XML file")
 
-        for i in range(3):
-            if re.match(re_eps_yy, list_epsilon[i]):
-                eps_yy_key = i
-                break
-
-        for i in range(3):
-            if re.match(re_eps_xx, list_epsilon[i]):
-                if not re.match(re_epx_xy, list_epsilon[i]):
-                    eps_xx_key = i
-                    break
-
-        force = dict(zip(stage_id, force_values))
-        time = dict(zip(stage_id, rel_time))
+        force = np.array(force_values)
+        time = np.array(rel_time)
 
         mesh = np.array(triangle)
 
-        strains = dict()
+        # all the elements found in at least one stage, sorted for the index lookup
+        element_set = np.unique(np.concatenate([coords[a_stage][0] for a_stage in stage_id]
+                                               + [np.empty(0, dtype=np.int64)]))
+
+        # values of the elements missing in a stage are left to nan
+        coords_a = np.full((len(stage_id), len(element_set), 3), np.nan)
+        for i_stage, a_stage in enumerate(stage_id):
+            stage_indexes, stage_coords = coords[a_stage]
+            _scatter(element_set, stage_indexes, stage_coords, coords_a[i_stage])
 
-        strains["eps_xx"] = comparison_surface_list[list_epsilon[eps_xx_key]]
-        strains["eps_yy"] = comparison_surface_list[list_epsilon[eps_yy_key]]
-        strains["eps_xy"] = comparison_surface_list[list_epsilon[eps_xy_key]]
+        strains_a = np.full((len(stage_id), len(element_set), 3), np.nan)
+        for i_eps, a_component in enumerate(("eps_xx", "eps_yy", "eps_xy")):
+            surface_component = strain_surfaces[a_component]
+            for i_stage, a_stage in enumerate(stage_id):
+                indexes, values = surface_component[a_stage][:2]
+                _scatter(element_set, indexes, values, strains_a[i_stage, :, i_eps])
 
         logging.info(f"{ptime.strftime('%H:%M:%S')} Done parsing xml")
 
-        return coords, strains, force, time, mesh
+        return coords_a, strains_a, force, time, mesh, element_set
 
 
-def read_file(path):
-    tree = ET.parse(path)
-    root = tree.getroot()
+def _scatter(element_set, indexes, values, out):
+    """
+    Write values at the position of their element in out, the values of elements out of element_set are dropped
+    :param np.ndarray element_set: sorted element indexes, corresponding to the first axis of out
+    :param np.ndarray indexes: element indexes of the values
+    :param np.ndarray values: values to write
+    :param np.ndarray out: array to write in
+    """
+    position = np.searchsorted(element_set, indexes)
+    is_known = position < len(element_set)
+    is_known[is_known] = element_set[position[is_known]] == indexes[is_known]
+    out[position[is_known]] = values[is_known]
 
+
+def read_file(path, max_workers=1):
     header_read, nominal_read, measured_read = None, None, None
 
-    for an_el in root:
-        if an_el.tag == "header":
-            logging.info(f"{ptime.strftime('%H:%M:%S')} start reading header")
-            header_el = an_el
-            header_read = read_header(header_el)
-            logging.info(f"{ptime.strftime('%H:%M:%S')} done reading header")
-        elif an_el.tag == "nominal":
-            logging.info(f"{ptime.strftime('%H:%M:%S')} start reading nominal")
-            nominal_el = an_el
-            nominal_read = read_nominal(nominal_el)
-            logging.info(f"{ptime.strftime('%H:%M:%S')} done reading nominal")
-        elif an_el.tag == "measured":
-            logging.info(f"{ptime.strftime('%H:%M:%S')} start reading measured")
-            measured_el = an_el
-            measured_read = read_measured(measured_el)
-            logging.info(f"{ptime.strftime('%H:%M:%S')} done reading measured")
+    # the stages of the sections are decoded by a pool of processes shared along the file
+    with _stage_executor(max_workers) as executor:
+        # stream the file, every section under the root is read as soon as it is complete, then freed
+        depth = 0
+        root = None
+        for event, an_el in ET.iterparse(path, events=("start", "end"), **_ITERPARSE_OPTIONS):
+            if event == "start":
+                if depth == 0:
+                    root = an_el
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+
+            if an_el.tag == "header":
+                logging.info(f"{ptime.strftime('%H:%M:%S')} start reading header")
+                header_el = an_el
+                header_read = read_header(header_el)
+                logging.info(f"{ptime.strftime('%H:%M:%S')} done reading header")
+            elif an_el.tag == "nominal":
+                logging.info(f"{ptime.strftime('%H:%M:%S')} start reading nominal")
+                nominal_el = an_el
+                nominal_read = read_nominal(nominal_el, executor=executor)
+                logging.info(f"{ptime.strftime('%H:%M:%S')} done reading nominal")
+            elif an_el.tag == "measured":
+                logging.info(f"{ptime.strftime('%H:%M:%S')} start reading measured")
+                measured_el = an_el
+                measured_read = read_measured(measured_el, executor=executor)
+                logging.info(f"{ptime.strftime('%H:%M:%S')} done reading measured")
+            root.clear()
 
     logging.info(f"{ptime.strftime('%H:%M:%S')} done reading file")
 
     return header_read, nominal_read, measured_read
 
 
-def read_nominal(nominal_el):
+def read_nominal(nominal_el, executor=None):
     comparison_surface_list = dict()
     dimension_list = []
+    # the stages of all the surface components are decoded together once collected
+    pending_stages = []
+    payloads = []
     for an_el in nominal_el:
         if an_el.tag == "comparison_surface_component":
             surf_comp_name = an_el.attrib["name"]
             buff_surf_comp = {}
             for under_el in an_el:
                 if under_el.tag == "actual":
-                    pass
+                    # not used, freed right away
+                    under_el.clear()
                 elif under_el.tag == "stage":
                     buff_surf_comp[under_el.attrib["id"]] = None
                 elif under_el.tag == "result":
                     for u_u_el in under_el:
                         if u_u_el.tag == "stage":
                             the_id = u_u_el.attrib["id"]
-                            if the_id in buff_surf_comp.keys():
-                                bytes_b64 = ""
-                                for chunk in u_u_el:
-                                    bytes_b64 += chunk.text
-                                buff_surf_comp[the_id] = read_surface_component_scalar(bytes_b64)
+                            if the_id in buff_surf_comp:
+                                bytes_b64 = "".join(chunk.text for chunk in u_u_el)
+                                pending_stages.append((buff_surf_comp, the_id))
+                                payloads.append(bytes_b64)
+                                # the chunks are not needed anymore once joined
+                                u_u_el.clear()
                             else:
                                 raise ValueError(
                                     "Invalid stage in results of comparison surface component " + str(surf_comp_name))
                 elif under_el.tag == "strain_semantic":
-                    pass
+                    under_el.clear()
                 else:
                     logging.error(under_el)
                     raise ValueError("Uknnown element in comparison surface component  " + str(surf_comp_name))
@@ -186,185 +261,238 @@ def read_nominal(nominal_el):
                             buff_force = float(u_u_el[0][2].attrib["value"])
                         buff_dimension.append((buff_time, buff_force))
             dimension_list.append(buff_dimension)
+
+    decoded = _decode_all(read_surface_component_scalar, payloads, executor)
+    for (buff_surf_comp, the_id), a_result in zip(pending_stages, decoded):
+        buff_surf_comp[the_id] = a_result
+
     return comparison_surface_list, dimension_list
 
 
 def read_header(header_el):
     stages_list = []
+    unit_factors = {}
     for an_el in header_el:
 
         if an_el.tag == "version":
-            logging.info("Version of the XML file is " + an_el.text)
-
-        elif an_el.tag == "length_unit":
-            logging.info("Length unit of the document is " + an_el.text)
-            if an_el.text == "mm":
-                length_unit_factor = 1
-            else:
-                raise ValueError("Unknown length unit format")
+            logging.info("Version of the XML file is %s", an_el.text)
 
-        elif an_el.tag == "time_unit":
-            logging.info("Time unit of the document is " + an_el.text)
-            if an_el.text == "s":
-                time_unit_factor = 1
-            else:
-                raise ValueError("Unknown time unit format")
-
-        elif an_el.tag == "force_unit":
-            logging.info("Force unit of the document is " + an_el.text)
-            if an_el.text == "N":
-                force_unit_factor = 1
-            elif an_el.text == "kN":
-                force_unit_factor = 1e3
-            else:
-                raise ValueError("Unknown force unit format")
-
-        elif an_el.tag == "angle_unit":
-            logging.info("Angle unit of the document is " + an_el.text)
-            if an_el.text == "deg":
-                angle_unit_factor = 1
-            elif an_el.text == "rad":
-                angle_unit_factor = 2 * np.pi / 360
-            else:
-                raise ValueError("Unknown angle unit format")
+        elif an_el.tag in _UNIT_TABLES:
+            quantity = an_el.tag[:-len("_unit")]
+            logging.info("%s unit of the document is %s", quantity.capitalize(), an_el.text)
+            try:
+                unit_factors[an_el.tag] = _UNIT_TABLES[an_el.tag][an_el.text]
+            except KeyError:
+                raise ValueError(f"Unknown {quantity} unit format") from None
 
         elif an_el.tag == "stage":
-            stages_list.append(an_el.attrib)
+            stages_list.append(dict(an_el.attrib))
         else:
             raise ValueError("Unknown element in Header")
 
-    logging.debug("Found {the_len} stage(s)".format(the_len=len(stages_list)))
+    logging.debug("Found %d stage(s)", len(stages_list))
 
-    return stages_list, (length_unit_factor, time_unit_factor, angle_unit_factor, force_unit_factor)
+    return stages_list, tuple(unit_factors[a_unit] for a_unit in ("length_unit", "time_unit", "angle_unit",
+                                                                  "force_unit"))
 
 
-def read_measured(measured_el):
+def read_measured(measured_el, executor=None):
     buff_triangle = None
-    buff_stages_surface = dict()
+    stage_ids = []
+    payloads = []
     for el in measured_el[0]:
         if el.tag == "triangles":
             buff_triangle = read_surface_component_triangles(el.text)
         elif el.tag == "stage":
-            buff_stages_surface[el.attrib["id"]] = read_surface_component_vertices(el[1][0].text)
+            stage_ids.append(el.attrib["id"])
+            payloads.append(el[1][0].text)
+
+    buff_stages_surface = dict(zip(stage_ids, _decode_all(read_surface_component_vertices, payloads, executor)))
     return buff_triangle, buff_stages_surface
 
 
+def _stage_executor(max_workers=1):
+    """
+    Pool of processes decoding the stages
+    :param max_workers: number of processes, all the cores if None
+    :return: a ProcessPoolExecutor, or a context giving None if the stages are to be decoded sequentially
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_workers == 1:
+        return contextlib.nullcontext()
+
+    # forking a process already running threads (numba, BLAS) can deadlock, the workers are started fresh instead
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _decode_all(decoder, payloads, executor=None):
+    """
+    Decode independent binary payloads
+    :param decoder: top level function decoding one payload
+    :param list payloads: payloads to decode
+    :param executor: pool of processes decoding the payloads, sequential decoding if None
+    :return list: decoded payloads, in the same order
+    """
+    if executor is None or len(payloads) < 2:
+        return [decoder(a_payload) for a_payload in payloads]
+    return list(executor.map(decoder, payloads, chunksize=4))
+
+
 def read_surface_component_scalar(string_binary):
-    message_bytes = base64.b64decode(string_binary.encode('utf-8'))
+    message_bytes = base64.b64decode(string_binary)
 
     off = 0
-    version = struct.unpack("<I", message_bytes[:LEN_INT])[0]
+    version = _U32.unpack_from(message_bytes, off)[0]
     off += LEN_INT
     unit_name = None
     if version >= 1:
-        len_string = struct.unpack("<I", message_bytes[off: off + LEN_INT])[0]
+        len_string = _U32.unpack_from(message_bytes, off)[0]
         off += LEN_INT
-        unit_name = struct.unpack("<" + str(len_string) + "s",
-                                  message_bytes[off: off + len_string * LEN_CHAR])[0].decode("latin-1")
+        unit_name = struct.unpack_from(f"<{len_string}s", message_bytes, off)[0].decode("latin-1")
         off += len_string * LEN_CHAR
 
-    n_vertices = struct.unpack("<I", message_bytes[off: off + LEN_INT])[0]
+    n_vertices = _U32.unpack_from(message_bytes, off)[0]
     off += LEN_INT
 
     dire_vect_flag = 0
     if version >= 2:
-        dire_vect_flag = struct.unpack("<B", message_bytes[off: off + LEN_CHAR])[0]
-        off += LEN_CHAR
-
-    indexes = np.empty(shape=(n_vertices,), dtype=float)
-    buff_scalar = np.empty(shape=(n_vertices,), dtype=float)
-    buff_vector = np.empty(shape=(n_vertices,3), dtype=float)
-
-    for i in range(n_vertices):
-        valid = struct.unpack("<B", message_bytes[off:off + LEN_CHAR])[0]
+        dire_vect_flag = _U8.unpack_from(message_bytes, off)[0]
         off += LEN_CHAR
-        if valid == 1:
-            indexes[i] = i
-            buff_scalar[i] = np.array(struct.unpack("<f", message_bytes[off:off + LEN_FLOAT]))
-            off += LEN_FLOAT
-            if dire_vect_flag == 1:
-                buff_vector[i, :] = np.array(struct.unpack("<fff", message_bytes[off:off + 3 * LEN_FLOAT]))
-                off += 3 * LEN_FLOAT
-        elif valid == 0:
-            indexes[i] = np.nan
-            continue
-        else:
-            raise RuntimeError("Error in decoding stage geometry, invalid Flag")
 
-    # drop nan values
+    if dire_vect_flag == 1:
+        record_dtype = np.dtype([("scalar", "<f4"), ("vector", "<f4", 3)])
+    else:
+        record_dtype = np.dtype([("scalar", "<f4")])
 
-    loc_nan = np.logical_not(np.isnan(indexes))
-    indexes = indexes[loc_nan]
-    buff_scalar = buff_scalar[loc_nan]
-    buff_vector = buff_vector[loc_nan]
+    indexes, records, off = _read_flagged_records(message_bytes, off, n_vertices, record_dtype)
+    buff_scalar = records["scalar"].astype(float)
 
     #if unit_name != 'log_strain':
     #    logging.warning("strain is not log strain, but " + unit_name)
 
     if dire_vect_flag == 1:
-        return indexes, buff_scalar, buff_vector
+        return indexes, buff_scalar, records["vector"].astype(float)
     else:
         return indexes, buff_scalar
 
 
 def read_surface_component_triangles(string_binary):
-    base64_bytes = string_binary.encode('utf-8')
-    message_bytes = base64.b64decode(base64_bytes)
-    len(message_bytes)
-
-    len_chain = len(message_bytes)
-    n_triangle = int((len_chain - 2 * LEN_INT) / (3 * LEN_INT))
-    triangle_unpack = struct.unpack("<II" + str(3 * n_triangle) + "I", message_bytes)
-    triangle_buff = []
-    for i in range(triangle_unpack[1]):
-        triangle_buff.append((triangle_unpack[2 + i * 3],
-                              triangle_unpack[2 + i * 3 + 1],
-                              triangle_unpack[2 + i * 3 + 2],))
+    message_bytes = base64.b64decode(string_binary)
+
+    n_triangle = _HDR_TRI.unpack_from(message_bytes, 0)[1]
+    if len(message_bytes) != _HDR_TRI.size + 3 * n_triangle * LEN_INT:
+        raise RuntimeError("Error in decoding mesh, invalid binary message length")
+
+    # the connectivity is a contiguous block of uint32 node indexes, three per triangle
+    triangle_buff = np.frombuffer(message_bytes, dtype="<u4", count=3 * n_triangle,
+                                  offset=_HDR_TRI.size).reshape(n_triangle, 3)
 
     return triangle_buff
 
 
 def read_surface_component_vertices(string_binary):
-    base64_bytes = string_binary.encode('utf-8')
-    message_bytes = base64.b64decode(base64_bytes)
-    offset_header = struct.calcsize("<I6dI")
-    header = struct.unpack("<I6dI", message_bytes[:offset_header])
-    min_corner = np.array(header[1:4])
-    max_corner = np.array(header[4:7])
+    message_bytes = base64.b64decode(string_binary)
+    offset_header = _HDR_VERT.size
+    header = _HDR_VERT.unpack_from(message_bytes, 0)
+    min_corner, max_corner = np.array(header[1:7]).reshape(2, 3)
     n_vertices = header[-1]
-    off = offset_header
-    vertices_cords_f = np.empty(shape=(n_vertices, 3), dtype=float)
-    indexes = np.empty(shape=(n_vertices,), dtype=int)
-
-    for i in range(n_vertices):
-        valid = struct.unpack("<B", message_bytes[off:off + 1])[0]
-        off += 1
-        if valid == 1:
-            indexes[i] = i
-            buff_vertices = struct.unpack("<III", message_bytes[off:off + 12])
-            vertices_cords_f[i, 0] = buff_vertices[0] / MAX_UINT
-            vertices_cords_f[i, 1] = buff_vertices[1] / MAX_UINT
-            vertices_cords_f[i, 2] = buff_vertices[2] / MAX_UINT
-            off = off + 3 * LEN_INT
-        elif valid == 0:
-            indexes[i] = -99999
-            continue
-        else:
-            raise RuntimeError("Error in decoding stage geometry, invalid Flag")
+    indexes, vertices_cords_i, off = _read_flagged_records(message_bytes, offset_header, n_vertices,
+                                                          np.dtype(("<u4", 3)))
 
     if off != len(message_bytes):
         raise RuntimeError("Error in decoding stage geometry, invalid binary message length")
 
-    loc_valid = indexes != -99999
-    indexes = indexes[loc_valid]
-    vertices_cords_f = vertices_cords_f[loc_valid]
+    # coordinates are stored normalised in the bounding box of the stage, the scale is computed once per axis,
+    # an empty stage gives a (0, 3) array
+    scale = (max_corner - min_corner) / MAX_UINT
+    vertices_cords = vertices_cords_i * scale + min_corner
+
+    return indexes, vertices_cords
 
-    if n_vertices != 0:
-        vertices_cords = np.array(
-            [(max_corner[i] - min_corner[i]) * vertices_cords_f[:, i] + min_corner[i] for i in range(3)])
 
-    vertices_dict = {}
-    for i in range(len(indexes)):
-        vertices_dict[indexes[i]] = vertices_cords[:, i]
+def _read_flagged_records(message_bytes, offset, n_records, record_dtype):
+    """
+    Decode a sequence of records, each one led by a validity flag byte: 1 for a valid record followed by its content,
+    0 for an invalid record without content
+    :param bytes message_bytes: binary message
+    :param int offset: position of the first flag in the message
+    :param int n_records: number of records, valid or not
+    :param np.dtype record_dtype: dtype of the content of a valid record
+    :return: indexes of the valid records, their content and the position following the last record
+    """
+    flagged_dtype = np.dtype([("valid", "u1"), ("record", record_dtype)])
+
+    # usual case, all the records are valid and can be read at once as fixed size structures
+    if len(message_bytes) - offset >= n_records * flagged_dtype.itemsize:
+        block = np.frombuffer(message_bytes, dtype=flagged_dtype, count=n_records, offset=offset)
+        if np.all(block["valid"] == 1):
+            return np.arange(n_records, dtype=np.int64), block["record"], offset + n_records * flagged_dtype.itemsize
+
+    # otherwise the position of every record depends on the validity of the previous ones,
+    # the message is then only accessed through a single byte view, without copy
+    message_uint8 = np.frombuffer(message_bytes, dtype=np.uint8)
+    if numba is not None:
+        indexes = _walk_flags_numba(message_uint8, offset, n_records, record_dtype.itemsize)
+    else:
+        indexes = np.flatnonzero(np.frombuffer(_walk_flags(message_bytes, offset, n_records, record_dtype.itemsize),
+                                               dtype=bool)).astype(np.int64, copy=False)
+    end_offset = offset + n_records + len(indexes) * record_dtype.itemsize
+    if end_offset > len(message_bytes):
+        raise RuntimeError("Error in decoding stage geometry, invalid binary message length")
+
+    # gather the content of the valid records, every one is preceded by its flag and the previous valid records
+    content_offsets = offset + indexes + 1 + record_dtype.itemsize * np.arange(len(indexes))
+    content_bytes = message_uint8[content_offsets[:, None] + np.arange(record_dtype.itemsize)]
+    records = content_bytes.view(np.dtype([("record", record_dtype)]))["record"][:, 0]
 
-    return vertices_dict
+    return indexes, records, end_offset
+
+
+def _walk_flags(message_bytes, offset, n_records, record_size):
+    """
+    Walk along the validity flags of a sequence of records, see _read_flagged_records
+    :param bytes message_bytes: binary message
+    :param int offset: position of the first flag in the message
+    :param int n_records: number of records, valid or not
+    :param int record_size: size of the content of a valid record
+    :return bytearray: 1 for the valid records, 0 for the invalid ones
+    """
+    is_valid = bytearray(n_records)
+    try:
+        for i in range(n_records):
+            flag = message_bytes[offset]
+            if flag == 1:
+                is_valid[i] = 1
+                offset += 1 + record_size
+            elif flag == 0:
+                offset += 1
+            else:
+                raise RuntimeError("Error in decoding stage geometry, invalid Flag")
+    except IndexError:
+        raise RuntimeError("Error in decoding stage geometry, invalid binary message length") from None
+    return is_valid
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _walk_flags_numba(message_uint8, offset, n_records, record_size):
+        """
+        Compiled equivalent of _walk_flags, the walk is sequential as every flag position depends on the previous ones
+        :return: indexes of the valid records
+        """
+        indexes = np.empty(n_records, dtype=np.int64)
+        n_valid = 0
+        for i in range(n_records):
+            if offset >= len(message_uint8):
+                raise RuntimeError("Error in decoding stage geometry, invalid binary message length")
+            flag = message_uint8[offset]
+            if flag == 1:
+                indexes[n_valid] = i
+                n_valid += 1
+                offset += 1 + record_size
+            elif flag == 0:
+                offset += 1
+            else:
+                raise RuntimeError("Error in decoding stage geometry, invalid Flag")
+        return indexes[:n_valid]
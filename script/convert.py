@@ -14,13 +14,34 @@
 
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
 
 from DIC_Exchange.convert_to import load_from
 
-path_dir = r"D:\HDD_Documents\Projet\ZugVersuch\CodeBase\Cut_Line_GUI\data_test"
 
-for a_path in os.listdir(path_dir):
-    if "hdf5" not in a_path:
-        dic_res = load_from(os.path.join(path_dir, a_path), force_rupture_ratio=.8)
-        dic_res.save_to_hdf5(os.path.join(path_dir, a_path[:-4] + ".hdf5"))
-        print("saved " + str(os.path.join(path_dir, a_path[:-4] + ".hdf5")))
\ No newline at end of file
+def convert_one(path_xml):
+    """
+    Convert one Aramis XML file to an HDF5 file next to it
+    :param path_xml: path of the XML file
+    :return: path of the HDF5 file
+    """
+    path_hdf5 = path_xml[:-4] + ".hdf5"
+    # the files are already converted in parallel, every one is decoded sequentially
+    dic_res = load_from(path_xml, force_rupture_ratio=.8, max_workers=1)
+    dic_res.save_to_hdf5(path_hdf5)
+    return path_hdf5
+
+
+# the files are converted in worker processes, the guard keeps them from running the conversion again
+if __name__ == "__main__":
+    path_dir = sys.argv[1]
+
+    with os.scandir(path_dir) as dir_entries:
+        paths_xml = [an_entry.path for an_entry in dir_entries
+                     if an_entry.is_file() and an_entry.name.lower().endswith(".xml")]
+
+    with ProcessPoolExecutor() as executor:
+        for path_hdf5 in tqdm(executor.map(convert_one, paths_xml), total=len(paths_xml)):
+            tqdm.write("saved " + path_hdf5)
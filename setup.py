@@ -30,6 +30,9 @@ setup(
             'tqdm',
             'matplotlib>=3.6.2'
         ],
+    extras_require={
+            'fast': ['numba', 'hdf5plugin', 'pybase64', 'lxml']
+        },
     classifiers=['Private :: Do Not Upload',
                  'Development Status :: 3 - Alpha',
                  'Programming Language :: Python :: 3',